@@ -1,6 +1,34 @@
-import json
 import os
 import glob
+from jsonl_utils import iter_jsonl, map_files
+
+# Document types (metadata['type']) counted as exercises in addition to EX_ IDs
+_EX_TYPES = frozenset(("Q&A", "Solved Example"))
+
+def _count_file(file_path):
+    """Classify one file's records; returns (concepts, exercises, concept_samples, bad_lines)."""
+    file_c = 0
+    file_e = 0
+    concept_samples = []
+    bad_lines = []
+    for line_num, data in iter_jsonl(file_path):
+        if data is None:
+            bad_lines.append(line_num)
+            continue
+        meta = data.get('metadata', {})
+        item_id = data.get('id', '')
+        
+        # Logic from rag_parse.py
+        doc_type = meta.get('type', '')
+        
+        is_exercise = item_id.startswith('EX_') or doc_type in _EX_TYPES
+        if is_exercise:
+            file_e += 1
+        else:
+            file_c += 1
+            if len(concept_samples) < 5:
+                concept_samples.append((item_id, doc_type))
+    return file_c, file_e, concept_samples, bad_lines
 
 def debug_rag_counts():
     rag_folder = "Subject Rag"
@@ -13,41 +41,18 @@ def debug_rag_counts():
     concepts_count = 0
     exercises_count = 0
     
-    for file_path in source_files:
+    # Parsed in file order (in worker processes only if REAN_PARALLEL_PARSE=1)
+    for file_path, result in zip(source_files, map_files(_count_file, source_files)):
+        file_c, file_e, concept_samples, bad_lines = result
         print(f"\nProcessing {file_path}...")
-        file_c = 0
-        file_e = 0
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for line_num, line in enumerate(f, 1):
-                line = line.strip()
-                if not line: continue
-                try:
-                    data = json.loads(line)
-                    meta = data.get('metadata', {})
-                    item_id = data.get('id', '')
-                    
-                    # Logic from rag_utils.py
-                    doc_type = meta.get('type', '')
-                    
-                    is_exercise = False
-                    if item_id.startswith('EX_'):
-                        is_exercise = True
-                    elif doc_type in ['Q&A', 'Solved Example']:
-                        is_exercise = True
-                        
-                    if is_exercise:
-                        exercises_count += 1
-                        file_e += 1
-                    else:
-                        concepts_count += 1
-                        file_c += 1
-                        # Print first few concepts to see what they are
-                        if concepts_count <= 5:
-                            print(f"   [Concept Sample] ID: {item_id}, Type: {doc_type}")
+        for line_num in bad_lines:
+            print(f"   ❌ Error decoding line {line_num}")
+        # Print first few concepts to see what they are
+        for item_id, doc_type in concept_samples[:max(0, 5 - concepts_count)]:
+            print(f"   [Concept Sample] ID: {item_id}, Type: {doc_type}")
 
-                except json.JSONDecodeError:
-                    print(f"   ❌ Error decoding line {line_num}")
-                    continue
+        concepts_count += file_c
+        exercises_count += file_e
         print(f"   -> Concepts: {file_c}, Exercises: {file_e}")
 
     print("\n" + "="*30)
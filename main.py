@@ -2,16 +2,26 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from llama_cpp import Llama
+from llama_cpp import Llama, LlamaRAMCache
 import uvicorn
 import rag_utils  # Import the RAG utility module
-import gc
-import json
+from jsonl_utils import dumps
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+import os
+import re
 import threading
-import time
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Heavy startup work runs here rather than at import time, so processes that
+    # re-import this module (e.g. the RAG file-parsing pool) don't load any models.
+    startup()
+    yield
 
 # 1. Initialize the App
-app = FastAPI(title="Khmer Grade 12 Tutor API")
+app = FastAPI(title="Khmer Grade 12 Tutor API", lifespan=lifespan)
 
 # Add CORS Middleware
 app.add_middleware(
@@ -36,33 +46,44 @@ MODELS = {
     }
 }
 
-# Global Model Variable
-llm = None
-current_model_name = "qwen"
-model_lock = threading.Lock()  # Prevent race conditions during model switching
-is_loading = False
+# Leave a couple of cores free for the API server and the embedding model
+LLAMA_THREADS = max(1, (os.cpu_count() or 4) - 2)
 
-def load_model(model_key: str):
-    global llm, current_model_name, is_loading
-    
+# Size of the per-model llama.cpp prompt cache. Prompts share their system prompt and
+# instructions, so the KV state for that prefix is reused instead of re-evaluated.
+PROMPT_CACHE_BYTES = 2 * 1024**3
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+# Set REAN_DEBUG=1 to log the detected intent, RAG matches and full prompt for every request
+if os.environ.get("REAN_DEBUG") == "1":
+    for logger_name in (__name__, "rag_utils"):
+        logging.getLogger(logger_name).setLevel(logging.DEBUG)
+
+# Loaded models, kept resident so switching between them is just a pointer swap
+llms: dict[str, Llama] = {}
+DEFAULT_MODEL = "qwen"
+current_model_name = DEFAULT_MODEL
+model_lock = threading.Lock()  # Prevent two threads from loading the same model
+# A Llama context isn't thread-safe, so each model runs one generation at a time
+inference_locks = {model_key: threading.Lock() for model_key in MODELS}
+
+def load_model(model_key: str) -> Llama:
+    """Load `model_key` unless it is already resident, and return it."""
     if model_key not in MODELS:
         raise ValueError(f"Model '{model_key}' not found.")
     
+    # Fast path: already loaded, no need to wait on a load in progress
+    if model_key in llms:
+        return llms[model_key]
+
     # Prevent concurrent model loading
     with model_lock:
-        is_loading = True
-        old_model_name = current_model_name
-        
-        # Unload existing model if any
-        if llm is not None and model_key != current_model_name:
-            print(f"♻️ Unloading {MODELS[old_model_name]['alias']}...")
-            del llm
-            llm = None
-            gc.collect()
-            time.sleep(0.5)  # Give time for cleanup
+        if model_key in llms:
+            return llms[model_key]
         
         config = MODELS[model_key]
-        print(f"⏳ Loading {config['alias']}... (This may take a few seconds)")
+        logger.info("⏳ Loading %s... (This may take a few seconds)", config['alias'])
         
         try:
             new_llm = Llama(
@@ -71,25 +92,62 @@ def load_model(model_key: str):
                 lora_scale=1.0,
                 n_ctx=2048,
                 n_gpu_layers=-1,
+                n_threads=LLAMA_THREADS,
+                n_batch=512,
+                n_ubatch=512,
+                flash_attn=True,
+                use_mmap=True,   # Page weights in from the GGUF instead of reading them up front
+                # Pin only the default model so decoding never waits on disk. Models loaded by
+                # preload_models stay demand-paged: two mlocked 7B Q4_K_M models (~9 GB) plus
+                # BGE-M3 would leave too little headroom on a 16 GB machine.
+                use_mlock=(model_key == DEFAULT_MODEL),
                 verbose=True
             )
-            # Only update globals after successful load
-            llm = new_llm
-            current_model_name = model_key
-            print(f"✅ {config['alias']} Loaded!")
         except Exception as e:
-            print(f"❌ Failed to load model: {e}")
-            # Restore old model name if load failed
-            current_model_name = old_model_name
+            logger.error("❌ Failed to load model: %s", e)
             raise e
-        finally:
-            is_loading = False
+
+        # Run one throwaway token so kernel setup isn't paid by the first real request.
+        # Done before attaching the prompt cache so the dummy prompt isn't stored in it.
+        try:
+            new_llm("hi", max_tokens=1)
+        except Exception as e:
+            logger.warning("⚠️ Warm-up of %s failed: %s", config['alias'], e)
+        new_llm.set_cache(LlamaRAMCache(capacity_bytes=PROMPT_CACHE_BYTES))
+
+        llms[model_key] = new_llm
+        logger.info("✅ %s Loaded!", config['alias'])
+        return new_llm
+
+def switch_model(model_key: str):
+    global current_model_name
+    # Only switch once the model is resident, so /generate never sees a half-loaded model
+    load_model(model_key)
+    current_model_name = model_key
+
+def preload_models():
+    # Load the remaining models in the background so /set_model doesn't have to
+    for model_key in MODELS:
+        try:
+            load_model(model_key)
+        except Exception:
+            # Already reported by load_model; /set_model will retry on demand
+            pass
 
 # 2. Load the Default Model on Startup
-load_model("qwen")
+def startup():
+    load_model(DEFAULT_MODEL)
 
-# Initialize RAG Database
-rag_utils.initialize_rag_db()
+    # Initialize RAG Database
+    rag_utils.initialize_rag_db()
+
+    # Warm up the retrieval path (embedding + FAISS search) before the first user hits it
+    try:
+        rag_utils.retrieve_context("វិទ្យាសាស្ត្រ")
+    except Exception as e:
+        logger.warning("⚠️ RAG warm-up failed: %s", e)
+
+    threading.Thread(target=preload_models, daemon=True).start()
 
 # 3. Define the Request Structure
 class ChatRequest(BaseModel):
@@ -103,7 +161,7 @@ class ModelSwitchRequest(BaseModel):
 @app.post("/set_model")
 def set_model(request: ModelSwitchRequest):
     try:
-        load_model(request.model)
+        switch_model(request.model)
         return {"message": f"Switched to {MODELS[request.model]['alias']}", "current_model": request.model}
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -119,80 +177,53 @@ def get_current_model():
     }
 
 # Helper: Intent Detection
-def detect_intent(query: str) -> str:
-    # Simple keyword matching for "Creation" intent
-    creation_keywords = [
-        "create", "generate", "make", "write", "compose", 
-        "បង្កើត", "តែង", "សរសេរ", "រកនឹក"
-    ]
-    query_lower = query.lower()
-    for word in creation_keywords:
-        if word in query_lower:
-            return "GENERATE"
-    return "SOLVE"
+# Simple keyword matching for "Creation" intent, compiled once into a single regex
+CREATION_KEYWORDS = [
+    "create", "generate", "make", "write", "compose", 
+    "បង្កើត", "តែង", "សរសេរ", "រកនឹក"
+]
+CREATION_RE = re.compile("|".join(map(re.escape, CREATION_KEYWORDS)), re.IGNORECASE)
 
-# 4. The Endpoint
-@app.post("/generate")
-def generate_response(request: ChatRequest):
-    global llm, is_loading
-    
-    # Prevent inference during model switching
-    if is_loading:
-        raise HTTPException(status_code=503, detail="Model is currently being loaded. Please wait.")
-    
-    if llm is None:
-        raise HTTPException(status_code=503, detail="Model is not loaded.")
-
-    # Use the instruction as the user query for RAG
-    user_query = request.instruction
-    if request.input_text:
-        user_query += f" {request.input_text}"
+def detect_intent(query: str) -> str:
+    return "GENERATE" if CREATION_RE.search(query) else "SOLVE"
 
-    try:
-        # Retrieve context
-        concept, exercise = rag_utils.retrieve_context(user_query)
-        context_text = f"{concept}\n{exercise}"
-        
-        # Detect Intent
-        intent = detect_intent(user_query)
-        print(f"DEBUG: Detected Intent: {intent}")
+# Prompt Templates
+# The static prompt bodies are split around their placeholders once at import time,
+# so each request only has to "".join() the pieces with its own context and query.
+def _split_prompt(template: str, *placeholders: str) -> tuple:
+    parts = []
+    rest = template
+    for name in placeholders:
+        head, rest = rest.split("{" + name + "}")
+        parts.append(head)
+    parts.append(rest)
+    return tuple(parts)
 
-        # --- DYNAMIC PROMPT STRATEGY ---
-        if "seallm" in current_model_name.lower():
-            # KHMER SEALLM STRATEGY (Khmer-Optimized)
-            # SeaLLM uses <|im_start|> format but optimized for Southeast Asian languages
-            if intent == "SOLVE":
-                # Very low temperature for accuracy and instruction following
-                temperature = 0.15
-                repeat_penalty = 1.3
-                
-                # SeaLLM-specific: Put RAG instruction in FIRST USER TURN (not system)
-                # System prompt should remain minimal as SeaLLM wasn't tuned for it
-                prompt = f"""<|im_start|>system
+# SeaLLM-specific: Put RAG instruction in FIRST USER TURN (not system)
+# System prompt should remain minimal as SeaLLM wasn't tuned for it
+# The fixed instructions come before the reference material and question so that
+# every SOLVE prompt shares the same prefix (see PROMPT_CACHE_BYTES).
+SEALLM_SOLVE_TEMPLATE = """<|im_start|>system
 អ្នកជាជំនួយការដែលមានប្រយោជន៍ និងត្រូវតែធ្វើតាមការណែនាំយ៉ាងតឹងរ៉ឹង។ អ្នកមិនត្រូវប្រើចំណេះដឹងខាងក្រៅ ឬសន្និដ្ឋានផ្ទាល់ខ្លួនឡើយ។ ប្រើតែព័ត៌មានពីឯកសារយោងប៉ុណ្ណោះ។</s><|im_start|>user
 អ្នកជាគ្រូបង្រៀនថ្នាក់ទី១២ ជំនាញរូបវិទ្យា គណិតវិទ្យា ជីវវិទ្យា និងប្រវត្តិសាស្ត្រ។
 
-ឯកសារយោង៖
-{context_text}
-
-សំណួរ៖ {user_query}
-
 សេចក្តីណែនាំ៖ 
-- សូមឆ្លើយសំណួរដោយប្រើតែព័ត៌មានពីឯកសារយោងខាងលើប៉ុណ្ណោះ។ កុំបន្ថែមព័ត៌មានខាងក្រៅ ឬសន្និដ្ឋានផ្ទាល់ខ្លួន។ បើឯកសារយោងមិនមានព័ត៌មានគ្រប់គ្រាន់ សូមឆ្លើយថា "ព័ត៌មានមិនគ្រប់គ្រាន់នៅក្នុងឯកសារយោង។"
+- សូមឆ្លើយសំណួរដោយប្រើតែព័ត៌មានពីឯកសារយោងខាងក្រោមប៉ុណ្ណោះ។ កុំបន្ថែមព័ត៌មានខាងក្រៅ ឬសន្និដ្ឋានផ្ទាល់ខ្លួន។ បើឯកសារយោងមិនមានព័ត៌មានគ្រប់គ្រាន់ សូមឆ្លើយថា "ព័ត៌មានមិនគ្រប់គ្រាន់នៅក្នុងឯកសារយោង។"
 - ចម្លើយត្រូវតែជាភាសាខ្មែរ។
 - មុននឹងឆ្លើយ សូមគិតជាជំហាន៖ ១. រកព័ត៌មានពាក់ព័ន្ធពីឯកសារយោង។ ២. បញ្ជាក់ថាអ្នកបានយកពីឯកសារយោងណា។ ៣. បន្ទាប់មកឆ្លើយ។
 - សម្រាប់គណិតវិទ្យា៖ បង្ហាញរូបមន្ត → ដោះស្រាយជាជំហាន → គណនា → ចម្លើយចុងក្រោយ។ ប្រើតែទិន្នន័យពីឯកសារយោង។
 - សម្រាប់គំនិត ឬពន្យល់៖ ប្រើចំណុចសំខាន់ៗពីឯកសារយោង និងបញ្ជាក់ប្រភពពីឯកសារយោង។
 
-ត្រូវតែធ្វើតាមសេចក្តីណែនាំនេះយ៉ាងតឹងរ៉ឹង បើមិនដូច្នោះទេ ចម្លើយមិនត្រឹមត្រូវ។</s><|im_start|>assistant
+ត្រូវតែធ្វើតាមសេចក្តីណែនាំនេះយ៉ាងតឹងរ៉ឹង បើមិនដូច្នោះទេ ចម្លើយមិនត្រឹមត្រូវ។
+
+ឯកសារយោង៖
+{context_text}
+
+សំណួរ៖ {user_query}</s><|im_start|>assistant
 """
-            else:
-                # Higher temperature for creativity in exercise generation
-                temperature = 0.65
-                repeat_penalty = 1.15
-                
-                # For generation, also use first user turn
-                prompt = f"""<|im_start|>system
+
+# For generation, also use first user turn
+SEALLM_GENERATE_TEMPLATE = """<|im_start|>system
 You are a helpful assistant.</s><|im_start|>user
 អ្នកជាគ្រូបង្រៀនថ្នាក់ទី១២។ សូមបង្កើតលំហាត់ ឬពន្យល់គំនិតដូចខាងក្រោម៖
 
@@ -201,12 +232,7 @@ You are a helpful assistant.</s><|im_start|>user
 សេចក្តីណែនាំ៖ ឆ្លើយជាភាសាខ្មែរ។ ច្នៃប្រឌិតនិងមានលក្ខណៈអប់រំ។</s><|im_start|>assistant
 """
 
-        else:
-            # QWEN 2.5 STRATEGY (Instruction Following Focused)
-            repeat_penalty = 1.1  # Default for Qwen
-            if intent == "SOLVE":
-                temperature = 0.1
-                system_prompt = """You are an expert Khmer Grade 12 Tutor.
+QWEN_SOLVE_SYSTEM_PROMPT = """You are an expert Khmer Grade 12 Tutor.
 Your goal is to read the student’s question and provide an accurate solution.
 Instructions:
 1. Answer strictly in Khmer.
@@ -217,16 +243,15 @@ Instructions:
    - Perform calculation (យើងបាន).
    - State the final answer (ដូចនេះ).
 4. If it is a conceptual question, explain clearly and concisely."""
-            else:
-                temperature = 0.7
-                system_prompt = """You are a Khmer Grade 12 Teacher.
+
+QWEN_GENERATE_SYSTEM_PROMPT = """You are a Khmer Grade 12 Teacher.
 Your goal is to create new exercises or explain concepts clearly based on the user's request.
 Instructions:
 1. Answer strictly in Khmer.
 2. Be creative and educational.
 3. If creating an exercise, Do not provide the solution, only when user asks for it."""
 
-            prompt = f"""<|im_start|>system
+QWEN_TEMPLATE = """<|im_start|>system
 {system_prompt}
 <|im_end|>
 <|im_start|>user
@@ -238,12 +263,71 @@ Instructions:
 <|im_end|>
 <|im_start|>assistant
 """
+
+SEALLM_SOLVE_PRE, SEALLM_SOLVE_MID, SEALLM_SOLVE_POST = _split_prompt(
+    SEALLM_SOLVE_TEMPLATE, "context_text", "user_query"
+)
+SEALLM_GENERATE_PRE, SEALLM_GENERATE_POST = _split_prompt(SEALLM_GENERATE_TEMPLATE, "user_query")
+QWEN_SOLVE_PRE, QWEN_SOLVE_MID, QWEN_SOLVE_POST = _split_prompt(
+    QWEN_TEMPLATE.replace("{system_prompt}", QWEN_SOLVE_SYSTEM_PROMPT), "context_text", "user_query"
+)
+QWEN_GENERATE_PRE, QWEN_GENERATE_MID, QWEN_GENERATE_POST = _split_prompt(
+    QWEN_TEMPLATE.replace("{system_prompt}", QWEN_GENERATE_SYSTEM_PROMPT), "context_text", "user_query"
+)
+
+# 4. The Endpoint
+@app.post("/generate")
+async def generate_response(request: ChatRequest):
+    # Snapshot the active model so a concurrent /set_model can't change it mid-request
+    model_name = current_model_name
+    llm = llms.get(model_name)
+    if llm is None:
+        raise HTTPException(status_code=503, detail="Model is not loaded.")
+
+    # Use the instruction as the user query for RAG
+    user_query = request.instruction
+    if request.input_text:
+        user_query += f" {request.input_text}"
+
+    try:
+        # Retrieve context
+        concept, exercise = await rag_utils.aretrieve_context(user_query)
+        context_text = "\n".join((concept, exercise))
         
-        print(f"DEBUG: Generated Prompt for {current_model_name}:\n{prompt}")
+        # Detect Intent
+        intent = detect_intent(user_query)
+        logger.debug("Detected Intent: %s", intent)
+
+        # --- DYNAMIC PROMPT STRATEGY ---
+        if "seallm" in model_name.lower():
+            # KHMER SEALLM STRATEGY (Khmer-Optimized)
+            # SeaLLM uses <|im_start|> format but optimized for Southeast Asian languages
+            if intent == "SOLVE":
+                # Very low temperature for accuracy and instruction following
+                temperature = 0.15
+                repeat_penalty = 1.3
+                prompt = "".join((SEALLM_SOLVE_PRE, context_text, SEALLM_SOLVE_MID, user_query, SEALLM_SOLVE_POST))
+            else:
+                # Higher temperature for creativity in exercise generation
+                temperature = 0.65
+                repeat_penalty = 1.15
+                prompt = "".join((SEALLM_GENERATE_PRE, user_query, SEALLM_GENERATE_POST))
 
-        def generate():
+        else:
+            # QWEN 2.5 STRATEGY (Instruction Following Focused)
+            repeat_penalty = 1.1  # Default for Qwen
+            if intent == "SOLVE":
+                temperature = 0.1
+                prompt = "".join((QWEN_SOLVE_PRE, context_text, QWEN_SOLVE_MID, user_query, QWEN_SOLVE_POST))
+            else:
+                temperature = 0.7
+                prompt = "".join((QWEN_GENERATE_PRE, context_text, QWEN_GENERATE_MID, user_query, QWEN_GENERATE_POST))
+        
+        logger.debug("Generated Prompt for %s:\n%s", model_name, prompt)
+
+        async def generate():
             # Yield prompt info first
-            yield json.dumps({"type": "info", "prompt": prompt}) + "\n"
+            yield dumps({"type": "info", "prompt": prompt}) + b"\n"
 
             # Prepare inference parameters
             inference_params = {
@@ -256,17 +340,39 @@ Instructions:
             }
             
             # Add repeat_penalty for SeaLLM to prevent repetition
-            if "seallm" in current_model_name.lower():
+            if "seallm" in model_name.lower():
                 inference_params["repeat_penalty"] = repeat_penalty
                 inference_params["top_p"] = 0.9
                 inference_params["top_k"] = 40
             
             # B. Run Inference
-            stream = llm(**inference_params)
-            
-            for output in stream:
-                token = output['choices'][0]['text']
-                yield json.dumps({"type": "token", "text": token}) + "\n"
+            # llama.cpp blocks while decoding, so it runs in a background thread that
+            # hands tokens to this coroutine through a queue. None marks the end.
+            queue = asyncio.Queue()
+            loop = asyncio.get_running_loop()
+            cancelled = threading.Event()
+
+            def produce():
+                try:
+                    with inference_locks[model_name]:
+                        for output in llm(**inference_params):
+                            if cancelled.is_set():
+                                break
+                            loop.call_soon_threadsafe(queue.put_nowait, output['choices'][0]['text'])
+                except Exception as e:
+                    loop.call_soon_threadsafe(queue.put_nowait, e)
+                finally:
+                    loop.call_soon_threadsafe(queue.put_nowait, None)
+
+            threading.Thread(target=produce, daemon=True).start()
+            try:
+                while (token := await queue.get()) is not None:
+                    if isinstance(token, Exception):
+                        raise token
+                    yield dumps({"type": "token", "text": token}) + b"\n"
+            finally:
+                # Stop decoding early if the client went away
+                cancelled.set()
 
         return StreamingResponse(generate(), media_type="application/x-ndjson")
     
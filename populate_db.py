@@ -1,70 +1,73 @@
-import json
+import logging
 import os
+import sys
+from collections import Counter
+from jsonl_utils import iter_jsonl, map_files, write_jsonl
+
+logger = logging.getLogger(__name__)
+
+def _read_records(file_path):
+    # Runs in a worker process: parse one file and drop undecodable lines
+    return [data for _, data in iter_jsonl(file_path) if data is not None]
 
 def populate_data():
-    print("🚀 Populating RAG Database with Full Data...")
+    logger.info("🚀 Populating RAG Database with Full Data...")
     
-    concepts = []
-    exercises = []
+    # Keyed by ID so duplicates are dropped as they are read (last one wins)
+    concepts: dict[str, dict] = {}
+    exercises: dict[str, dict] = {}
+    # ID prefix breakdown (TH, EM, EX, ...), counted once per unique ID
+    concept_prefixes = Counter()
+    exercise_prefixes = Counter()
     
     # Files to read from
     source_files = ["physics_concepts_rag.jsonl", "physics_exercise_rag.jsonl"]
     
+    existing_files = []
     for file_path in source_files:
         if not os.path.exists(file_path):
-            print(f"⚠️ Warning: {file_path} not found. Skipping.")
+            logger.warning("⚠️ Warning: %s not found. Skipping.", file_path)
             continue
             
-        print(f"📖 Reading {file_path}...")
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    data = json.loads(line)
-                    item_id = data.get('id', '')
-                    
-                    # Categorize based on ID prefix
-                    if item_id.startswith('EX_'):
-                        exercises.append(data)
-                    else:
-                        # Assume everything else is a concept (TH_, EM_, WV_, etc.)
-                        concepts.append(data)
-                        
-                except json.JSONDecodeError:
-                    continue
+        logger.info("📖 Reading %s...", file_path)
+        existing_files.append(file_path)
 
-    # Remove duplicates (based on ID)
-    unique_concepts = {c['id']: c for c in concepts}.values()
-    unique_exercises = {e['id']: e for e in exercises}.values()
+    # Parsed in file order (in worker processes only if REAN_PARALLEL_PARSE=1)
+    for records in map_files(_read_records, existing_files):
+        for data in records:
+            item_id = data.get('id', '')
+            
+            # Categorize based on ID prefix
+            # Assume everything that isn't EX_ is a concept (TH_, EM_, WV_, etc.)
+            if item_id.startswith('EX_'):
+                target, prefixes = exercises, exercise_prefixes
+            else:
+                target, prefixes = concepts, concept_prefixes
+            if item_id not in target:
+                prefixes[item_id.partition('_')[0]] += 1
+            target[item_id] = data
     
-    print(f"✅ Found {len(unique_concepts)} unique concepts.")
-    print(f"✅ Found {len(unique_exercises)} unique exercises.")
+    logger.info("✅ Found %d unique concepts.", len(concepts))
+    logger.info("✅ Found %d unique exercises.", len(exercises))
 
     # Analyze prefixes for clarity
-    from collections import Counter
-    concept_prefixes = Counter([c['id'].split('_')[0] for c in unique_concepts])
-    exercise_prefixes = Counter([e['id'].split('_')[0] for e in unique_exercises])
-    
-    print("\n📊 Breakdown by ID Prefix:")
-    print("Concepts:")
+    logger.info("📊 Breakdown by ID Prefix:")
+    logger.info("Concepts:")
     for prefix, count in concept_prefixes.items():
-        print(f"  - {prefix}: {count}")
-    print("Exercises:")
+        logger.info("  - %s: %d", prefix, count)
+    logger.info("Exercises:")
     for prefix, count in exercise_prefixes.items():
-        print(f"  - {prefix}: {count}")
-    print("")
+        logger.info("  - %s: %d", prefix, count)
     
     # Write to destination files
-    print("💾 Writing to physics_concepts.jsonl...")
-    with open("physics_concepts.jsonl", "w", encoding="utf-8") as f:
-        for entry in unique_concepts:
-            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    logger.info("💾 Writing to physics_concepts.jsonl...")
+    write_jsonl("physics_concepts.jsonl", concepts.values())
             
-    print("💾 Writing to physics_exercises.jsonl...")
-    with open("physics_exercises.jsonl", "w", encoding="utf-8") as f:
-        for entry in unique_exercises:
-            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    logger.info("💾 Writing to physics_exercises.jsonl...")
+    write_jsonl("physics_exercises.jsonl", exercises.values())
             
-    print("🎉 Data Population Complete!")
+    logger.info("🎉 Data Population Complete!")
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
     populate_data()
@@ -0,0 +1,36 @@
+from jsonl_utils import iter_jsonl
+
+# Kept free of heavy imports (torch, faiss, langchain) so that parsing doesn't depend on
+# them; this module is what map_files workers unpickle when REAN_PARALLEL_PARSE=1.
+
+# Document types (metadata['type']) indexed as exercises in addition to EX_ IDs
+_EX_TYPES = frozenset(("Solved Example",))
+
+def parse_rag_file(file_path):
+    """Parse one RAG .jsonl file into (item_id, is_exercise, page_content, metadata) tuples.
+
+    May run in a worker process, so it returns plain tuples instead of Documents.
+    """
+    records = []
+    for _, data in iter_jsonl(file_path):
+        if data is None:
+            continue
+        # Combine title and content for the page_content
+        title = data.get('khmer_title', '')
+        body = data.get('content', '')
+        content = f"{title}\n{body}" if title else body
+        
+        meta = data.get('metadata', {})
+        item_id = data.get('id', '')
+        meta['id'] = item_id
+        
+        # If metadata is empty, try to populate it from root fields (for concepts)
+        if not meta:
+            for key in ['subject', 'chapter', 'topic', 'khmer_title']:
+                if key in data:
+                    meta[key] = data[key]
+
+        doc_type = meta.get('type', '')
+        is_exercise = item_id.startswith('EX_') or doc_type in _EX_TYPES
+        records.append((item_id, is_exercise, content, meta))
+    return records
@@ -1,62 +1,242 @@
+import asyncio
+import hashlib
 import json
+import logging
 import os
 import glob
+import pickle
+import uuid
+import faiss
+import numpy as np
+import torch
+from functools import lru_cache
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_core.documents import Document
+from jsonl_utils import map_files
+from rag_parse import parse_rag_file
 
-# Global variables to hold the vector stores
-db_concepts = None
-db_exercises = None
+logger = logging.getLogger(__name__)
+
+# Global variables to hold the vector store (concepts and exercises share one index)
+db = None
 embedding_model = None
 
+# On-disk cache of built indices, keyed by a fingerprint of the source files
+CACHE_DIR = "rag_cache"
+MANIFEST_PATH = os.path.join(CACHE_DIR, "manifest.json")
+# Bump whenever the way indices are built changes, so stale caches get rebuilt
+INDEX_VERSION = 7
+
+# Documents per encoder forward pass when embedding the corpus
+EMBED_BATCH_SIZE = 128
+
+# HNSW graph parameters: neighbours per node, build-time and query-time beam width
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+# Corpora at least this large use IVF-PQ instead: IVFPQ_NLIST coarse clusters (IVF_NPROBE
+# probed per query) and vectors compressed to IVFPQ_M bytes of 8-bit PQ codes each.
+# faiss wants >= 39 training points per centroid, and both the coarse quantizer
+# (IVFPQ_NLIST) and each PQ sub-quantizer (2**IVFPQ_NBITS) have 256: 9,984 at least.
+# Raise this alongside IVFPQ_NLIST / IVFPQ_NBITS.
+IVFPQ_MIN_DOCS = 10_000
+IVFPQ_NLIST = 256
+IVFPQ_M = 64
+IVFPQ_NBITS = 8
+IVF_NPROBE = 16
+
+# Cosine similarity (inner product of L2-normalized vectors): 1.0 = Identical, 0.0 = Unrelated.
+# Results below this are dropped to avoid irrelevant cross-subject matches.
+# 0.6 matches the earlier squared-L2 cutoff of 0.8 (squared L2 = 2 - 2 * cos for unit vectors).
+SIMILARITY_THRESHOLD = 0.6
+
+# Number of distinct queries whose embeddings are kept in memory
+QUERY_CACHE_SIZE = 2048
+
+# Metadata key tagging each document as a CONCEPT or an EXERCISE within the shared index
+CATEGORY_KEY = 'category'
+CONCEPT = 'concept'
+EXERCISE = 'exercise'
+
+# Neighbours fetched per query; the best concept and best exercise are picked from these
+RETRIEVE_K = 10
+
 def load_and_split_docs(file_paths):
     concepts_docs = []
     exercises_docs = []
-    
+    # Skip repeated IDs so the same document is never embedded twice
+    seen_ids = set()
+
+    existing_files = []
     for file_path in file_paths:
         if not os.path.exists(file_path):
-            print(f"⚠️ Warning: {file_path} not found.")
+            logger.warning("⚠️ Warning: %s not found.", file_path)
             continue
-            
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    data = json.loads(line)
-                    # Combine title and content for the page_content
-                    title = data.get('khmer_title', '')
-                    body = data.get('content', '')
-                    content = f"{title}\n{body}" if title else body
-                    
-                    meta = data.get('metadata', {})
-                    item_id = data.get('id', '')
-                    meta['id'] = item_id
-                    
-                    # If metadata is empty, try to populate it from root fields (for concepts)
-                    if not meta:
-                        for key in ['subject', 'chapter', 'topic', 'khmer_title']:
-                            if key in data:
-                                meta[key] = data[key]
-
-                    doc = Document(page_content=content, metadata=meta)
-                    
-                    doc_type = meta.get('type', '')
-                    if item_id.startswith('EX_') or doc_type in ['Solved Example']:
-                        exercises_docs.append(doc)
-                    else:
-                        concepts_docs.append(doc)
-                except json.JSONDecodeError:
+        existing_files.append(file_path)
+    
+    # Parsed in file order (in worker processes only if REAN_PARALLEL_PARSE=1)
+    for records in map_files(parse_rag_file, existing_files):
+        for item_id, is_exercise, content, meta in records:
+            if item_id:
+                if item_id in seen_ids:
                     continue
+                seen_ids.add(item_id)
+
+            meta[CATEGORY_KEY] = EXERCISE if is_exercise else CONCEPT
+            doc = Document(page_content=content, metadata=meta)
+            if is_exercise:
+                exercises_docs.append(doc)
+            else:
+                concepts_docs.append(doc)
     return concepts_docs, exercises_docs
 
+def _embedding_device():
+    if torch.backends.mps.is_available():
+        return "mps"
+    if torch.cuda.is_available():
+        return "cuda"
+    return "cpu"
+
+def _tune_index(index):
+    # efSearch / nprobe trade recall for speed; set them explicitly after every build/load
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    elif isinstance(index, faiss.IndexIVF):
+        index.nprobe = IVF_NPROBE
+    return index
+
+def _wrap_index(index, docstore, index_to_docstore_id):
+    # BGE-M3 is trained for cosine similarity: vectors are searched by inner product.
+    # They are already L2-normalized in _build_index and _embed_query, so the wrapper
+    # isn't asked to normalize (it warns that doing so doesn't apply to inner product).
+    return FAISS(
+        embedding_model, index, docstore, index_to_docstore_id,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+    )
+
+def _build_index(docs):
+    """Embed `docs` and wrap them in an HNSW (or, for large corpora, IVF-PQ) FAISS store."""
+    vectors = np.asarray(
+        embedding_model.embed_documents([doc.page_content for doc in docs]), dtype="float32"
+    )
+    faiss.normalize_L2(vectors)
+    dim = vectors.shape[1]
+    # Approximate search instead of the IndexFlatL2 brute-force scan FAISS.from_documents uses
+    if len(vectors) >= IVFPQ_MIN_DOCS:
+        # Product quantization stores IVFPQ_M bytes per vector instead of 4 * dim
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFPQ(
+            quantizer, dim, IVFPQ_NLIST, IVFPQ_M, IVFPQ_NBITS, faiss.METRIC_INNER_PRODUCT
+        )
+        index.train(vectors)
+    else:
+        index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    index.add(vectors)
+    _tune_index(index)
+
+    docstore_ids = [str(uuid.uuid4()) for _ in docs]
+    docstore = InMemoryDocstore(dict(zip(docstore_ids, docs)))
+    return _wrap_index(index, docstore, dict(enumerate(docstore_ids)))
+
+def _sources_fingerprint(source_files):
+    """Hash the RAG source paths, sizes and mtimes (plus INDEX_VERSION)."""
+    digest = hashlib.sha256(f"v{INDEX_VERSION}\n".encode())
+    for path in sorted(source_files):
+        stat = os.stat(path)
+        digest.update(f"{path}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+# Memory-mapping flags per index kind (recorded in the manifest). IVF inverted lists are
+# mapped by IO_FLAG_MMAP, which needs faiss's plain file reader. Flat code storage (IndexFlat,
+# also inside IndexHNSWFlat) is mapped by IO_FLAG_MMAP_IFC, which older faiss builds don't have.
+_MMAP_FLAGS = {
+    'ivf': faiss.IO_FLAG_MMAP,
+    'flat': getattr(faiss, "IO_FLAG_MMAP_IFC", 0),
+}
+
+def _index_kind(index):
+    return 'ivf' if isinstance(index, faiss.IndexIVF) else 'flat'
+
+def _read_index(path, kind):
+    # Memory-map the index so the OS pages it in lazily instead of reading it all up front
+    flags = _MMAP_FLAGS.get(kind, 0)
+    if not flags:
+        logger.info("ℹ️ This faiss build can't memory-map %s indices; reading %s into RAM", kind, path)
+        return faiss.read_index(path)
+    try:
+        return faiss.read_index(path, flags | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError as e:
+        logger.warning("⚠️ Could not memory-map %s, reading it into RAM: %s", path, e)
+        return faiss.read_index(path)
+
+def _load_cached_indices(fingerprint):
+    """Return {name: FAISS} from CACHE_DIR if it matches `fingerprint`, else None."""
+    try:
+        with open(MANIFEST_PATH, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if manifest.get('fingerprint') != fingerprint:
+        return None
+
+    indices = {}
+    try:
+        for name, kind in manifest.get('indices', {}).items():
+            # Same layout FAISS.save_local writes (index.faiss + index.pkl), but the
+            # raw index is read via _read_index so it can be memory-mapped where supported.
+            folder = os.path.join(CACHE_DIR, name)
+            index = _tune_index(_read_index(os.path.join(folder, "index.faiss"), kind))
+            with open(os.path.join(folder, "index.pkl"), 'rb') as f:
+                docstore, index_to_docstore_id = pickle.load(f)
+            indices[name] = _wrap_index(index, docstore, index_to_docstore_id)
+    except Exception as e:
+        # Truncated files (EOFError), docstore classes changed by a langchain upgrade
+        # (AttributeError/ModuleNotFoundError), ... all just mean the cache must be rebuilt
+        logger.warning("⚠️ RAG cache is unreadable, rebuilding: %s", e)
+        return None
+    return indices
+
+def _save_indices(indices, fingerprint):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Invalidate the old manifest first: a rebuild can have the same fingerprint, and a
+    # crash while the index files are being overwritten must not leave it pointing at them
+    if os.path.exists(MANIFEST_PATH):
+        os.remove(MANIFEST_PATH)
+    # {name: index kind}, so the loader can pick the right mmap flags
+    saved = {}
+    for name, store in indices.items():
+        if store is not None:
+            store.save_local(os.path.join(CACHE_DIR, name))
+            saved[name] = _index_kind(store.index)
+    # Write the manifest last, atomically, so a half-written cache is never treated as valid
+    tmp_path = MANIFEST_PATH + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'fingerprint': fingerprint, 'indices': saved}, f, indent=2)
+    os.replace(tmp_path, MANIFEST_PATH)
+
 def initialize_rag_db():
-    global db_concepts, db_exercises, embedding_model
+    global db, embedding_model
     
-    print("⏳ Initializing RAG Database...")
+    logger.info("⏳ Initializing RAG Database...")
     
     # Initialize Embedding Model
-    # Using BAAI/bge-m3 as requested
-    embedding_model = HuggingFaceEmbeddings(model_name="BAAI/bge-m3")
+    # Using BAAI/bge-m3 as requested. Run it in fp16 on the GPU (fp32 on CPU, where
+    # half precision is slower) and encode in large, normalized batches.
+    device = _embedding_device()
+    dtype = torch.float32 if device == "cpu" else torch.float16
+    _embed_query.cache_clear()
+    embedding_model = HuggingFaceEmbeddings(
+        model_name="BAAI/bge-m3",
+        model_kwargs={"device": device, "model_kwargs": {"torch_dtype": dtype}},
+        encode_kwargs={"batch_size": EMBED_BATCH_SIZE, "normalize_embeddings": True},
+    )
+    # Warm up so the first real query doesn't pay the one-off graph/kernel setup cost
+    embedding_model.embed_query("warmup")
     
     # Load Documents from the new RAG files
     # Recursively find all .jsonl files in "Subject Rag" folder
@@ -64,66 +244,92 @@ def initialize_rag_db():
     source_files = glob.glob(os.path.join(rag_folder, "**/*.jsonl"), recursive=True)
     
     if not source_files:
-        print(f"⚠️ No .jsonl files found in {rag_folder}")
+        logger.warning("⚠️ No .jsonl files found in %s", rag_folder)
     else:
-        print(f"📂 Found {len(source_files)} RAG files: {source_files}")
+        logger.info("📂 Found %d RAG files: %s", len(source_files), source_files)
+
+    # Reuse the index from the last run if the source files haven't changed
+    fingerprint = _sources_fingerprint(source_files)
+    cached = _load_cached_indices(fingerprint)
+    if cached is not None:
+        db = cached.get('documents')
+        logger.info("✅ Loaded RAG index from %s/", CACHE_DIR)
+        logger.info("✅ RAG Database Ready!")
+        return
 
     concepts_docs, exercises_docs = load_and_split_docs(source_files)
     
     if not concepts_docs:
-        print("⚠️ No concept documents found.")
+        logger.warning("⚠️ No concept documents found.")
     if not exercises_docs:
-        print("⚠️ No exercise documents found.")
+        logger.warning("⚠️ No exercise documents found.")
 
-    # Create FAISS Indices
-    # We build them in memory for now. In a production app, you might load from disk.
-    if concepts_docs:
-        db_concepts = FAISS.from_documents(concepts_docs, embedding_model)
-        print(f"✅ Concepts Index Built ({len(concepts_docs)} docs)")
-    
-    if exercises_docs:
-        db_exercises = FAISS.from_documents(exercises_docs, embedding_model)
-        print(f"✅ Exercises Index Built ({len(exercises_docs)} docs)")
+    # Create one FAISS Index for both kinds of document, told apart by metadata[CATEGORY_KEY]
+    db = None
+    docs = concepts_docs + exercises_docs
+    if docs:
+        db = _build_index(docs)
+        logger.info(
+            "✅ RAG Index Built (%d concepts, %d exercises)", len(concepts_docs), len(exercises_docs)
+        )
+
+    _save_indices({'documents': db}, fingerprint)
+    logger.info("💾 Saved RAG index to %s/", CACHE_DIR)
         
-    print("✅ RAG Database Ready!")
+    logger.info("✅ RAG Database Ready!")
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _embed_query(query):
+    """Embed and L2-normalize a query; cached since users often retry the same question."""
+    query_vec = np.asarray(embedding_model.embed_query(query), dtype="float32")[None, :]
+    faiss.normalize_L2(query_vec)
+    # Shared between callers through the cache: treat it as read-only
+    return query_vec
+
+def _best_matches(query_vec, subject=None):
+    """Return {category: (doc, similarity)} for the closest concept and exercise above SIMILARITY_THRESHOLD."""
+    matches = {}
+    scores, ids = db.index.search(query_vec, min(RETRIEVE_K, db.index.ntotal))
+    for score, idx in zip(scores[0], ids[0]):
+        # Hits come back best-first, so nothing after this one can qualify either
+        if idx == -1 or score < SIMILARITY_THRESHOLD:
+            break
+        doc = db.docstore.search(db.index_to_docstore_id[idx])
+        if subject is not None and doc.metadata.get('subject') != subject:
+            continue
+        matches.setdefault(doc.metadata.get(CATEGORY_KEY), (doc, float(score)))
+        if CONCEPT in matches and EXERCISE in matches:
+            break
+    return matches
 
 def retrieve_context(query, subject=None):
-    global db_concepts, db_exercises
-    
     concept_text = "No relevant concept found."
     exercise_text = "No relevant exercise found."
     
-    # L2 Distance Threshold: Lower is better.
-    # 0.0 = Identical, ~1.0 = Unrelated (Orthogonal for normalized vectors)
-    # We filter out results with high distance to avoid irrelevant cross-subject matches.
-    SCORE_THRESHOLD = 0.8
-    
-    # Prepare metadata filter if subject is known
-    filter_args = {}
-    if subject:
-        filter_args['filter'] = {'subject': subject}
+    if not db:
+        return concept_text, exercise_text
+
+    # Strip + lowercase so trivially different spellings of a query share a cache entry
+    query_vec = _embed_query(query.strip().lower())
     
-    if db_concepts:
-        # Retrieve top 1 concept with score
-        results = db_concepts.similarity_search_with_score(query, k=1, **filter_args)
-        if results:
-            doc, score = results[0]
-            # Only use the result if it's sufficiently similar
-            if score < SCORE_THRESHOLD:
-                print(f"✅ Best Concept Match: {score:.4f}")
-                concept_text = f"{doc.page_content}\n\n(Similarity Score: {score:.4f})"
+    # One search over the shared index yields both the top concept and the top exercise
+    matches = _best_matches(query_vec, subject)
+    if CONCEPT in matches:
+        doc, score = matches[CONCEPT]
+        logger.debug("✅ Best Concept Match: %.4f", score)
+        concept_text = f"{doc.page_content}\n\n(Similarity Score: {score:.4f})"
             
-    if db_exercises:
-        # Retrieve top 1 exercise with score
-        results = db_exercises.similarity_search_with_score(query, k=1, **filter_args)
-        if results:
-            doc, score = results[0]
-            if score < SCORE_THRESHOLD:
-                print(f"✅ Best Exercise Match: {score:.4f}")
-                exercise_text = f"{doc.page_content}\n\n(Similarity Score: {score:.4f})"
+    if EXERCISE in matches:
+        doc, score = matches[EXERCISE]
+        logger.debug("✅ Best Exercise Match: %.4f", score)
+        exercise_text = f"{doc.page_content}\n\n(Similarity Score: {score:.4f})"
             
     return concept_text, exercise_text
 
+async def aretrieve_context(query, subject=None):
+    # Embedding + FAISS search are CPU-bound; keep them off the event loop
+    return await asyncio.to_thread(retrieve_context, query, subject)
+
 def format_rag_prompt(user_query, concept, exercise):
     # Check if we have valid content (not the default failure messages)
     has_concept = concept and not concept.startswith("No relevant concept")